@@ -1,17 +1,195 @@
 ""
+import asyncio
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from functools import lru_cache
+import hashlib
+import math
 from pathlib import Path
+import threading
+import weakref
+from types import MappingProxyType
+from typing import Annotated, Literal, Mapping, Optional
 
 import rasterio as rio
-from rasterio.windows import from_bounds
+from rasterio.coords import disjoint_bounds
+from rasterio.enums import Resampling
+from rasterio.errors import RasterioError
+from rasterio.warp import transform_bounds
+from rasterio.windows import Window, from_bounds, round_window_to_full_blocks
+from rasterio.windows import bounds as window_bounds
 
 import numpy as np
 from PIL import Image
 import io
-from fastapi import FastAPI
+from fastapi import FastAPI, Header
+from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import Response
 import mercantile
 
-app = FastAPI()
+TILE_DIR = Path("data/cogs")
+IMAGE_SIZE = 256
+# Upper limit on the number of tile windows precomputed at startup
+MAX_CACHED_WINDOWS = 10_000
+# Number of rendered tiles kept in memory. An encoded 256x256 RGBA tile is at most
+# ~260 KB (an incompressible PNG) so the cache is bounded at ~70 MB, and real
+# imagery tiles are usually a fraction of that
+MAX_CACHED_TILES = 256
+# How long clients may cache tiles for
+CACHE_CONTROL = "public, max-age=3600"
+
+# PIL format, media type and save options for each output format. zlib level 1 costs
+# ~10% in size over the default level 6 but is several times cheaper to encode
+IMAGE_FORMATS = {
+    "png": ("PNG", "image/png", {"compress_level": 1, "optimize": False}),
+    "webp": ("WEBP", "image/webp", {"quality": 85, "method": 0}),
+}
+
+# GDAL dataset handles are not thread safe, so each threadpool worker reads through
+# its own handle. Open handles are tracked weakly so they can be closed on shutdown
+_thread_local = threading.local()
+_thread_datasets = weakref.WeakSet()
+
+
+class TileOutsideBounds(Exception):
+    """Raised when a requested xyz tile does not overlap the dataset"""
+    pass
+
+
+@dataclass(frozen=True, eq=False)
+class Source:
+    """
+    The COG being served along with the read windows precomputed for it
+
+    A snapshot is swapped into app.state in a single assignment, so a render never pairs
+    one dataset with another's windows. Snapshots hash by identity, which keeps the tile
+    cache entries of each one separate.
+    """
+    path: Optional[Path] = None
+    mtime: Optional[float] = None
+    src: Optional[rio.DatasetReader] = None
+    window_cache: Mapping[mercantile.Tile, Window] = field(default_factory=dict)
+
+
+def scan_tiles(state) -> list[Path]:
+    """
+    Return the COGs in TILE_DIR, only re-globbing when the directory has been modified
+    """
+    mtime = TILE_DIR.stat().st_mtime if TILE_DIR.exists() else None
+    if mtime != state.tiles_mtime:
+        state.tiles = sorted(TILE_DIR.glob("*.tif"))
+        state.tiles_mtime = mtime
+    return state.tiles
+
+
+def zoom_range(src: rio.DatasetReader, image_size: int) -> tuple[int, int]:
+    """
+    Zoom levels from the COG's coarsest overview to its native resolution
+    """
+    world_size = 2 * math.pi * 6378137
+    maxzoom = round(math.log2(world_size / (image_size * src.res[0])))
+    overviews = src.overviews(1)
+    minzoom = maxzoom - round(math.log2(max(overviews))) if overviews else maxzoom
+    return max(minzoom, 0), max(maxzoom, 0)
+
+
+def tile_windows(src: rio.DatasetReader, image_size: int) -> dict[mercantile.Tile, Window]:
+    """
+    Precompute the read window of every xyz tile covering src within its zoom range
+
+    Zoom levels are added coarsest first until MAX_CACHED_WINDOWS would be exceeded,
+    tiles beyond that fall back to computing their window per request.
+    """
+    windows = {}
+    west, south, east, north = transform_bounds(src.crs, "EPSG:4326", *src.bounds)
+    minzoom, maxzoom = zoom_range(src, image_size)
+    for z in range(minzoom, maxzoom + 1):
+        top_left = mercantile.tile(west, north, z)
+        bottom_right = mercantile.tile(east, south, z)
+        n_tiles = (bottom_right.x - top_left.x + 1) * (bottom_right.y - top_left.y + 1)
+        if len(windows) + n_tiles > MAX_CACHED_WINDOWS:
+            break
+        for tile in mercantile.tiles(west, south, east, north, [z]):
+            bounds = mercantile.xy_bounds(tile)
+            if not disjoint_bounds(bounds, src.bounds):
+                windows[tile] = from_bounds(*bounds, src.transform)
+    return windows
+
+
+def open_source(state, path: Optional[Path], mtime: Optional[float]) -> None:
+    """
+    Serve tiles from the COG at path, last modified at mtime, or from nothing if path
+    is None
+
+    If the COG can't be opened, e.g. it is still being copied in, the previous dataset
+    keeps being served and the failure is remembered so the file isn't retried until
+    it changes. The dataset being replaced isn't closed here as a render running in the
+    threadpool may still be using it, it is released once nothing references it.
+    """
+    src, window_cache = None, {}
+    if path is not None:
+        try:
+            src = rio.open(path, sharing=False)
+            window_cache = tile_windows(src, IMAGE_SIZE)
+        except RasterioError as e:
+            print(f"Unable to open {path}: {e}")
+            if src is not None:
+                src.close()
+            state.failed_source = (path, mtime)
+            return
+
+    state.source = Source(path, mtime, src, MappingProxyType(window_cache))
+    cached_tile.cache_clear()
+
+
+def source_is_current(state, path: Optional[Path], mtime: Optional[float]) -> bool:
+    """Whether the COG at path, last modified at mtime, has already been opened or tried"""
+    return (path, mtime) in (
+        (state.source.path, state.source.mtime),
+        state.failed_source,
+    )
+
+
+async def refresh_source(state) -> None:
+    """
+    Reopen the served COG if TILE_DIR no longer starts with the file that is open, or
+    that file has been rewritten since it was opened
+
+    The COG is opened in the threadpool, requests arriving meanwhile wait on
+    state.refresh_lock and then find it already open rather than opening it again.
+    """
+    tiles = scan_tiles(state)
+    path = tiles[0] if tiles else None
+    try:
+        mtime = path.stat().st_mtime if path is not None else None
+    except FileNotFoundError:
+        # Removed since TILE_DIR was last globbed, the next scan will pick that up
+        return
+    if source_is_current(state, path, mtime):
+        return
+    async with state.refresh_lock:
+        if not source_is_current(state, path, mtime):
+            await run_in_threadpool(open_source, state, path, mtime)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Open the dataset once so each request doesn't re-scan the directory and re-parse
+    # the COG header, requests only stat TILE_DIR and the COG to pick up changes
+    app.state.tiles = []
+    app.state.tiles_mtime = None
+    app.state.failed_source = None
+    app.state.source = Source()
+    app.state.refresh_lock = asyncio.Lock()
+    await refresh_source(app.state)
+    yield
+    if app.state.source.src is not None:
+        app.state.source.src.close()
+    for handle in list(_thread_datasets):
+        handle.close()
+
+
+app = FastAPI(lifespan=lifespan)
 
 
 @app.get("/")
@@ -21,55 +199,234 @@ async def root():
 
 @app.get("/list_tiles/")
 async def list_tiles():
-    tile_dir = Path("data/cogs")
-    tiles = list(tile_dir.glob("*.tif"))
+    # Only lists the directory, so unreadable files are still reported
+    tiles = scan_tiles(app.state)
     return {"count": len(tiles), "tiles": [str(tile) for tile in tiles]}
 
 
+def thread_dataset(
+    src: rio.DatasetReader, overview_level: Optional[int] = None
+) -> rio.DatasetReader:
+    """
+    Return a handle on the file behind src owned by the calling thread, opening it on
+    first use and reopening it once src has been replaced by a newer version of the file
+
+    If overview_level is given the handle is on that overview of the COG, rather than
+    the full resolution image. Each thread only keeps handles for the last src it read
+    from, and only a weak reference to src itself so a replaced dataset can be released.
+    """
+    opened_for = getattr(_thread_local, "src", None)
+    if opened_for is None or opened_for() is not src:
+        # Only the owning thread ever reads through these handles, so they are safe to close
+        for handle in getattr(_thread_local, "datasets", {}).values():
+            handle.close()
+        _thread_local.src = weakref.ref(src)
+        _thread_local.datasets = {}
+    handle = _thread_local.datasets.get(overview_level)
+    if handle is None or handle.closed:
+        if overview_level is None:
+            handle = rio.open(src.name, sharing=False)
+        else:
+            handle = rio.open(src.name, sharing=False, overview_level=overview_level)
+        _thread_local.datasets[overview_level] = handle
+        _thread_datasets.add(handle)
+    return handle
+
+
+def window_inside(window: Window, src: rio.DatasetReader) -> bool:
+    return (
+        window.col_off >= 0
+        and window.row_off >= 0
+        and window.col_off + window.width <= src.width
+        and window.row_off + window.height <= src.height
+    )
+
+
+def read_block_aligned(src: rio.DatasetReader, window: Window) -> np.ndarray:
+    """
+    Read a window as whole internal blocks of the COG and crop the result to window
+
+    Reading whole blocks avoids GDAL decoding a block only to copy out a sub-block strip.
+    """
+    aligned = round_window_to_full_blocks(window, src.block_shapes).intersection(
+        Window(0, 0, src.width, src.height)
+    )
+    data = src.read([1, 2, 3], window=aligned)
+    row = window.row_off - aligned.row_off
+    col = window.col_off - aligned.col_off
+    return data[:, row : row + window.height, col : col + window.width]
+
+
+def read_tile(
+    src: rio.DatasetReader,
+    tile: mercantile.Tile,
+    image_size: int,
+    window_cache: Mapping[mercantile.Tile, Window],
+) -> np.ndarray:
+    """
+    Read the RGB bands of src covering an xyz tile, resampled to image_size x image_size
+
+    Decimated reads are served by GDAL from the closest COG overview, so only the
+    internal blocks of that overview which overlap the tile are read. src is only used
+    for metadata, the read itself goes through the calling thread's own handle.
+    """
+    window = window_cache.get(tile)
+    if window is None:
+        bounds = mercantile.xy_bounds(tile)
+        if disjoint_bounds(bounds, src.bounds):
+            raise TileOutsideBounds(f"{tile} does not overlap {src.name}")
+        window = from_bounds(*bounds, src.transform)
+
+    reader = thread_dataset(src)
+
+    # Where the tile's resolution matches the full image or one of the COG's overviews,
+    # the tile is a plain pixel window of that level and needs no resampling
+    decimation = np.array([window.width, window.height]) / image_size
+    levels = [(None, 1)] + list(enumerate(reader.overviews(1)))
+    for level, factor in levels:
+        if not np.isclose(decimation, factor, rtol=1e-3).all():
+            continue
+        dataset = reader if level is None else thread_dataset(src, level)
+        level_window = from_bounds(
+            *window_bounds(window, src.transform), dataset.transform
+        )
+        pixel_window = Window(
+            round(level_window.col_off), round(level_window.row_off), image_size, image_size
+        )
+        if window_inside(pixel_window, dataset):
+            return read_block_aligned(dataset, pixel_window)
+        break
+
+    # Only pay for a boundless (VRT backed) read on tiles straddling the dataset edge
+    return reader.read(
+        [1, 2, 3],
+        window=window,
+        out_shape=(3, image_size, image_size),
+        resampling=Resampling.nearest,
+        boundless=not window_inside(window, src),
+        fill_value=0,
+    )
+
+
+def to_rgba(data: np.ndarray) -> np.ndarray:
+    """
+    Convert a (3, height, width) array to a (height, width, 4) uint8 RGBA array
+
+    Pixels that are zero in every band are made transparent. The output is allocated
+    once in the interleaved layout PIL expects and each channel is filled in place
+    through a band-first view, so no transpose copy is needed afterwards.
+    """
+    _, height, width = data.shape
+    rgba = np.empty((height, width, 4), dtype=np.uint8)
+    out = rgba.transpose(2, 0, 1)
+    if data.dtype == np.uint8:
+        out[:3] = data
+    elif np.issubdtype(data.dtype, np.unsignedinteger):
+        # The lower bound can't be hit, so saturate the top in a single pass
+        np.minimum(data, 255, out=out[:3], casting="unsafe")
+    else:
+        np.clip(data, 0, 255, out=out[:3], casting="unsafe")
+    alpha = out[3]
+    np.any(out[:3], axis=0, out=alpha.view(bool))
+    np.multiply(alpha, 255, out=alpha)
+    return rgba
+
+
+def encode_image(image: Image.Image, fmt: str) -> bytes:
+    """
+    Encode an image to bytes in one of IMAGE_FORMATS
+    """
+    pil_format, _, options = IMAGE_FORMATS[fmt]
+    with io.BytesIO() as buf:
+        image.save(buf, format=pil_format, **options)
+        return buf.getvalue()
+
+
+# Fully transparent tile returned whenever a read fails, encoded once per format
+_BLANK_TILES = {
+    fmt: encode_image(Image.new("RGBA", (IMAGE_SIZE, IMAGE_SIZE)), fmt)
+    for fmt in IMAGE_FORMATS
+}
+
+
+def render_tile(
+    src: rio.DatasetReader,
+    tile: mercantile.Tile,
+    image_size: int,
+    window_cache: Mapping[mercantile.Tile, Window],
+    fmt: str,
+) -> bytes:
+    """
+    Read an xyz tile from src and encode it as an RGBA image in one of IMAGE_FORMATS
+    """
+    data = read_tile(src, tile, image_size, window_cache)
+    rgba = to_rgba(data)
+
+    image = Image.frombuffer(
+        "RGBA",
+        (image_size, image_size),
+        rgba,
+        "raw",
+        "RGBA",
+        0,
+        1,
+    )
+    return encode_image(image, fmt)
+
+
+@lru_cache(maxsize=MAX_CACHED_TILES)
+def cached_tile(source: Source, tile: mercantile.Tile, fmt: str) -> tuple[bytes, str]:
+    """
+    Render a tile from source along with its ETag, keeping the most recent in memory
+
+    source is part of the cache key so that tiles rendered from an older version of the
+    COG are not served once refresh_source has reopened it.
+    """
+    im_bytes = render_tile(source.src, tile, IMAGE_SIZE, source.window_cache, fmt)
+    etag = f'"{hashlib.md5(im_bytes).hexdigest()}"'
+    return im_bytes, etag
+
+
 # Get a window of the first tile (like an xyz tile server)
 @app.get(
     "/tile/{z}/{x}/{y}",
-    responses={200: {"content": {"image/png": {}}}},
+    responses={
+        200: {
+            "content": {media_type: {} for _, media_type, _ in IMAGE_FORMATS.values()}
+        },
+        304: {"description": "Tile unchanged since the ETag in If-None-Match"},
+    },
     response_class=Response,
 )
-async def get_tile(x: int, y: int, z: int):
+async def get_tile(
+    x: int,
+    y: int,
+    z: int,
+    fmt: Literal["png", "webp"] = "png",
+    if_none_match: Annotated[Optional[str], Header()] = None,
+):
     print(x, y, z)
     tile = mercantile.Tile(x=x, y=y, z=z)
 
-    tile_dir = Path("data/cogs")
-    tile_path = list(tile_dir.glob("*.tif"))[0]
-    image_size = 256
+    media_type = IMAGE_FORMATS[fmt][1]
     try:
-        with rio.open(tile_path) as src:
-            data = src.read(
-                [1, 2, 3],
-                window=from_bounds(
-                    *mercantile.xy_bounds(tile), src.transform, image_size, image_size
-                ),
-                out_shape=(3, image_size, image_size),
-            )
-            data = np.clip(data, 0, 255).astype(np.uint8)
-            mask = (data != 0).any(axis=0).astype(np.uint8) * 255
-            data = np.concatenate([data, mask[np.newaxis, :, :]], axis=0)
-
-        image = Image.fromarray(data.transpose(1, 2, 0), "RGBA")
-
-        
-
-        with io.BytesIO() as buf:
-            image.save(buf, format="PNG")
-            im_bytes = buf.getvalue()
-
-        # return as a png
-        headers = {"Content-Disposition": 'inline; filename="test.png"'}
-
-        return Response(im_bytes, headers=headers, media_type="image/png")
-    except Exception as e:
-        array = np.zeros((256, 256, 4), dtype=np.uint8)
+        await refresh_source(app.state)
+        source = app.state.source
+        if source.src is None:
+            raise FileNotFoundError(f"No tiles found in {TILE_DIR}")
+        # Run the blocking GDAL read and encode off the event loop
+        im_bytes, etag = await run_in_threadpool(cached_tile, source, tile, fmt)
 
-        image = Image.fromarray(array, mode="RGBA")
-        with io.BytesIO() as buf:
-            image.save(buf, format="PNG")
-            im_bytes = buf.getvalue()
+        headers = {"Cache-Control": CACHE_CONTROL, "ETag": etag}
+        if if_none_match is not None and (
+            if_none_match.strip() == "*"
+            or etag in (tag.strip() for tag in if_none_match.split(","))
+        ):
+            return Response(status_code=304, headers=headers)
+
+        headers["Content-Disposition"] = f'inline; filename="test.{fmt}"'
+
+        return Response(im_bytes, headers=headers, media_type=media_type)
+    except Exception as e:
         print(e)
-        return Response(im_bytes, media_type="image/png")
+        return Response(_BLANK_TILES[fmt], media_type=media_type)
@@ -0,0 +1,43 @@
+""
+from pathlib import Path
+from typing import Union
+
+import morecantile
+from rio_cogeo.cogeo import cog_translate
+from rio_cogeo.profiles import cog_profiles
+
+
+def to_web_cog(
+    src_path: Union[str, Path],
+    dst_path: Union[str, Path],
+    profile: str = "deflate",
+) -> Path:
+    """
+    Convert a raster to a Cloud Optimized GeoTIFF aligned to the web mercator tile grid
+
+    The output is reprojected to EPSG:3857 with internal blocks and overviews matching
+    the GoogleMapsCompatible (WebMercatorQuad) tiling scheme, so each xyz tile served by
+    the api maps onto whole blocks of a single overview level.
+
+    Args:
+        src_path: str | Path
+            Path to the source raster
+        dst_path: str | Path
+            Path to write the COG to
+        profile: str
+            Name of the rio-cogeo compression profile
+
+    Returns:
+        Path
+
+    """
+    dst_path = Path(dst_path)
+    dst_path.parent.mkdir(parents=True, exist_ok=True)
+    cog_translate(
+        str(src_path),
+        str(dst_path),
+        cog_profiles.get(profile),
+        tms=morecantile.tms.get("WebMercatorQuad"),
+        quiet=True,
+    )
+    return dst_path
@@ -21,8 +21,10 @@
 # ############################################################################
 import re
 
+import numpy as np
+
 __version__ = '1.0.3'
-__all__ = ['to_osgb36', 'from_osgb36']
+__all__ = ['to_osgb36', 'to_osgb36_batch', 'from_osgb36']
 
 
 class BNGError(Exception):
@@ -59,7 +61,21 @@ def _init_regions_and_offsets():
     return regions, offset_map
 
 
+def _init_offset_array(offset_map):
+    # Offsets indexed by the packed region code (c0 - 'A') * 26 + (c1 - 'A'),
+    # with -1 marking codes that aren't valid 100 km grid squares
+    offsets = np.full((26 * 26, 2), -1, dtype=np.int64)
+    for region, (x_offset, y_offset) in offset_map.items():
+        offsets[_region_code(region)] = (x_offset, y_offset)
+    return offsets
+
+
+def _region_code(region):
+    return (ord(region[0]) - 65) * 26 + (ord(region[1]) - 65)
+
+
 _regions, _offset_map = _init_regions_and_offsets()
+_offset_array = _init_offset_array(_offset_map)
 
 
 def to_osgb36(gridref):
@@ -120,3 +136,68 @@ def to_osgb36(gridref):
     resolution = 10 ** (6 - (half_figs))
 
     return x, y, resolution
+
+
+def to_osgb36_batch(gridrefs):
+    """
+    Convert an array of British National Grid references to OSGB36 numeric
+    coordinates in one vectorised pass. Accepts the same 4, 6, 8 or 10 figure
+    references as to_osgb36.
+
+    :param gridrefs: array-like of str - BNG grid references
+    :returns coords: tuple - x, y, resolution int64 arrays
+
+    Examples:
+
+    >>> x, y, resolution = to_osgb36_batch(['HU431392', 'SJ637560', 'TV374354'])
+    >>> x
+    array([443100, 363700, 537400])
+    >>> y
+    array([1139200,  356000,   35400])
+    """
+    gridrefs = np.char.upper(np.asarray(gridrefs, dtype=str))
+    lengths = np.char.str_len(gridrefs)
+    valid_length = np.isin(lengths, (6, 8, 10, 12))
+    if not valid_length.all():
+        raise BNGError(
+            'Valid gridref inputs are 4, 6, 8 or 10-fig references as strings '
+            'e.g. "NN123321". [{}]'.format(gridrefs[~valid_length][0]))
+
+    try:
+        # Fixed width byte view, one row of ASCII codes per reference
+        buf = gridrefs.astype('S12').view(np.uint8).reshape(-1, 12)
+    except UnicodeEncodeError:
+        raise BNGError('Grid references must be ASCII strings')
+
+    letters = buf[:, :2].astype(np.int64) - 65
+    digits = buf[:, 2:].astype(np.int64) - 48
+    figs = lengths - 2
+    is_digit = (digits >= 0) & (digits <= 9)
+    padded = np.arange(10) >= figs[:, np.newaxis]
+    bad = ~((letters >= 0) & (letters < 26)).all(axis=1)
+    bad |= ~(is_digit | padded).all(axis=1)
+    if bad.any():
+        raise BNGError('Invalid grid reference: {}'.format(gridrefs[bad][0]))
+
+    offsets = _offset_array[letters[:, 0] * 26 + letters[:, 1]]
+    invalid_region = offsets[:, 0] < 0
+    if invalid_region.any():
+        raise BNGError('Invalid 100 km grid square code: {}'.format(
+            gridrefs[invalid_region][0][:2]))
+
+    easting = np.zeros(len(buf), dtype=np.int64)
+    northing = np.zeros(len(buf), dtype=np.int64)
+    half_figs = figs // 2
+    # At most four distinct reference lengths, each converted as a block
+    for n in np.unique(half_figs):
+        rows = half_figs == n
+        powers = 10 ** np.arange(n - 1, -1, -1, dtype=np.int64)
+        easting[rows] = digits[rows, :n] @ powers
+        northing[rows] = digits[rows, n:2 * n] @ powers
+
+    scale_factor = 10 ** (5 - half_figs)
+    x = easting * scale_factor + offsets[:, 0]
+    y = northing * scale_factor + offsets[:, 1]
+    resolution = 10 ** (6 - half_figs)
+
+    return x, y, resolution
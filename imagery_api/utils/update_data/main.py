@@ -7,16 +7,25 @@ import asyncio
 import aiohttp
 
 import numpy as np
+import orjson
 import requests
 import geopandas as gpd
-from shapely.geometry import box
+import shapely
 import pandas as pd
 from tqdm import tqdm
 
-from geo import to_osgb36
+try:
+    import uvloop
+except ImportError:  # uvloop isn't available on Windows
+    uvloop = None
+
+from geo import to_osgb36_batch
 
 
 API_URL = "https://environment.data.gov.uk/backend/catalog/api/tiles/collections/survey/search"
+# Cap on in-flight requests to the catalogue api, above this the server starts throttling
+MAX_CONCURRENT_REQUESTS = 16
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60)
 
 
 def get_england():
@@ -83,19 +92,19 @@ def tile_gdf(
     ymaxs = ymins + side_length
 
     # Create a GeoDataFrame from the boxes
-    
-    boxes = gpd.GeoSeries(
-        [box(xmin, ymin, xmax, ymax) for xmin, ymin, xmax, ymax in zip(xmins, ymins, xmaxs, ymaxs)]
-    )
+    boxes = gpd.GeoSeries(shapely.box(xmins, ymins, xmaxs, ymaxs), crs=gdf.crs)
 
     box_gdf = gpd.GeoDataFrame(geometry=boxes, crs=gdf.crs)
 
     if filter_empty:
         # Filter out empty boxes
         gdf["geometry"] = gdf.geometry.make_valid()
-        gdf["geometry"] = gdf.buffer(0)
 
-        box_gdf = box_gdf[box_gdf.intersects(gdf.union_all())]
+        # Query an STRtree of the boxes rather than testing each box against a union
+        # of every geometry, so each box is only compared with nearby polygons
+        tree = shapely.STRtree(box_gdf.geometry.values)
+        _, box_idx = tree.query(gdf.geometry.values, predicate="intersects")
+        box_gdf = box_gdf.iloc[np.unique(box_idx)].reset_index(drop=True)
     return box_gdf
 
 
@@ -128,59 +137,74 @@ def parse_response(results_df:pd.DataFrame):
     json_columns = ["product", "year", "resolution", "tile", "label"]
     parsed_json = {}
     for column in json_columns:
-        parsed_df = pd.json_normalize(results_df[column])
+        # The columns hold flat dicts, so build the frame directly rather than
+        # paying for json_normalize's recursive flattening
+        parsed_df = pd.DataFrame(results_df[column].tolist(), index=results_df.index)
         parsed_df.columns = [f"{column}_{col}" for col in parsed_df.columns]
         parsed_json[column] = parsed_df
     
     results_df = results_df.drop(columns=json_columns)
-    parsed_df_all_cols = pd.concat([results_df] +[df for df in parsed_json.values()], axis=1)
+    parsed_df_all_cols = pd.concat(
+        [results_df] + [df for df in parsed_json.values()], axis=1, copy=False
+    )
     
     return parsed_df_all_cols
 
 async def ingest_data(tile_gdf: gpd.GeoDataFrame):
     request_bodies = construct_request_bodies(tile_gdf)
-    response_dfs = []
+    # Accumulate raw records and build a single DataFrame at the end, rather than
+    # concatenating one DataFrame per tile
+    records = []
     
-    async with aiohttp.ClientSession() as session:
+    # Reuse keep-alive connections and cached DNS lookups across requests
+    connector = aiohttp.TCPConnector(
+        limit=MAX_CONCURRENT_REQUESTS, ttl_dns_cache=300, keepalive_timeout=60
+    )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    async with aiohttp.ClientSession(
+        connector=connector,
+        timeout=REQUEST_TIMEOUT,
+        json_serialize=lambda obj: orjson.dumps(obj).decode(),
+    ) as session:
         # Create a list of tasks to run concurrently
-        tasks = [request_tile(session, API_URL, request_body) for request_body in request_bodies]
+        tasks = [
+            request_tile(session, API_URL, request_body, semaphore)
+            for request_body in request_bodies
+        ]
         
         # Process responses concurrently
         for future in tqdm(asyncio.as_completed(tasks), total=len(request_bodies)):
-            response_df = await future
-            response_dfs.append(response_df)
+            records.extend(await future)
     
     # Parse the responses    
     print("Parsing responses")
-    response_df = parse_response(pd.concat(response_dfs, ignore_index=True))
+    response_df = parse_response(pd.DataFrame.from_records(records))
 
     return response_df
 
-async def request_tile(session: aiohttp.ClientSession, url: str, feature: dict):
+async def request_tile(
+    session: aiohttp.ClientSession,
+    url: str,
+    feature: dict,
+    semaphore: asyncio.Semaphore,
+):
     headers = {
         "Content-Type": "application/geo+json"
     }
-    async with session.post(url, json=feature, headers=headers) as response:
-        response.raise_for_status()
-        response_json = await response.json()
-        results_df = pd.DataFrame.from_dict(response_json["results"])
-    
-    return results_df
+    async with semaphore:
+        async with session.post(url, json=feature, headers=headers) as response:
+            response.raise_for_status()
+            response_json = orjson.loads(await response.read())
 
-def parse_geometry(df: pd.DataFrame) -> gpd.GeoDataFrame:
-    x, y, resolution = zip(*[to_osgb36(tile) for tile in df.tile_id])
+    return response_json["results"]
 
-    x = np.array(x)
-    y = np.array(y)
-    resolution = np.array(resolution)
-    resolution = resolution / 2
-
-    xmin = x
-    xmax = x + resolution
-    ymin = y
-    ymax = y + resolution
+def parse_geometry(df: pd.DataFrame) -> gpd.GeoDataFrame:
+    x, y, resolution = to_osgb36_batch(df.tile_id.to_numpy())
 
-    geometry = [box(xmin, ymin, xmax, ymax) for xmin, ymin, xmax, ymax in zip(xmin, ymin, xmax, ymax)]
+    # Resolutions are powers of ten, so integer halving is exact and keeps the
+    # arithmetic in int64 rather than promoting to float64
+    half = resolution // 2
+    geometry = shapely.box(x, y, x + half, y + half)
 
     gdf = gpd.GeoDataFrame(df, geometry=geometry, crs="EPSG:27700")
     return gdf
@@ -193,7 +217,8 @@ def main(
     tiles = tile_gdf(england, 50_000)
     
 
-    products_df = asyncio.run(ingest_data(tiles))
+    run = uvloop.run if uvloop is not None else asyncio.run
+    products_df = run(ingest_data(tiles))
     products_df = products_df[~products_df.duplicated()]
     products_gdf = parse_geometry(products_df)
 
@@ -0,0 +1,45 @@
+import mercantile
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.transform import from_origin
+
+from imagery_api.utils.cogs import to_web_cog
+
+# Top left z16 tile of the fixture imagery, which spans 4 x 4 tiles at that zoom
+ORIGIN_TILE = mercantile.Tile(x=32400, y=21600, z=16)
+FIXTURE_SIZE = 1024
+# Pixels are constant within aligned 8 x 8 blocks, so nearest neighbour reads of the
+# full image, its overviews or a warped VRT all agree regardless of which pixel in a
+# block they sample
+BLOCK = 8
+
+
+@pytest.fixture(scope="session")
+def raw_path(tmp_path_factory):
+    bounds = mercantile.xy_bounds(ORIGIN_TILE)
+    res = (bounds.right - bounds.left) / 256
+    n_blocks = FIXTURE_SIZE // BLOCK
+    rng = np.random.default_rng(0)
+    blocks = rng.integers(1, 256, (3, n_blocks, n_blocks), dtype=np.uint8)
+    data = blocks.repeat(BLOCK, axis=1).repeat(BLOCK, axis=2)
+
+    path = tmp_path_factory.mktemp("raw") / "raw.tif"
+    with rio.open(
+        path,
+        "w",
+        driver="GTiff",
+        width=FIXTURE_SIZE,
+        height=FIXTURE_SIZE,
+        count=3,
+        dtype="uint8",
+        crs="EPSG:3857",
+        transform=from_origin(bounds.left, bounds.top, res, res),
+    ) as dst:
+        dst.write(data)
+    return path
+
+
+@pytest.fixture(scope="session")
+def cog_path(raw_path, tmp_path_factory):
+    return to_web_cog(raw_path, tmp_path_factory.mktemp("cogs") / "fixture.tif")
@@ -0,0 +1,62 @@
+import numpy as np
+import pytest
+
+from imagery_api.utils.update_data.geo import (
+    BNGError,
+    _offset_map,
+    to_osgb36,
+    to_osgb36_batch,
+)
+
+
+def random_gridrefs(n, seed=0):
+    rng = np.random.default_rng(seed)
+    regions = sorted(_offset_map)
+    gridrefs = []
+    for _ in range(n):
+        region = regions[rng.integers(len(regions))]
+        figs = rng.choice([4, 6, 8, 10])
+        digits = "".join(str(d) for d in rng.integers(0, 10, figs))
+        gridrefs.append(region + digits)
+    return gridrefs
+
+
+def test_batch_matches_scalar():
+    gridrefs = random_gridrefs(5000)
+    x, y, resolution = to_osgb36_batch(gridrefs)
+
+    expected_x, expected_y, expected_resolution = zip(*[to_osgb36(g) for g in gridrefs])
+    np.testing.assert_array_equal(x, expected_x)
+    np.testing.assert_array_equal(y, expected_y)
+    np.testing.assert_array_equal(resolution, expected_resolution)
+    assert x.dtype == y.dtype == resolution.dtype == np.int64
+
+
+def test_batch_is_case_insensitive():
+    x, y, resolution = to_osgb36_batch(["sj637560", "SJ637560"])
+    assert x[0] == x[1] and y[0] == y[1] and resolution[0] == resolution[1]
+
+
+def test_batch_empty():
+    x, y, resolution = to_osgb36_batch([])
+    assert len(x) == len(y) == len(resolution) == 0
+
+
+@pytest.mark.parametrize(
+    "gridref",
+    [
+        "SJ123",  # odd number of figures
+        "SJ12",  # too few figures
+        "SJ123456789012",  # too many figures
+        "SJ12A4",  # non-digit
+        "1J1234",  # non-letter region
+        "XX1234",  # invalid 100 km square
+        "SJ12é4",  # non-ASCII
+        None,
+    ],
+)
+def test_batch_invalid(gridref):
+    with pytest.raises(BNGError):
+        to_osgb36(gridref)
+    with pytest.raises(BNGError):
+        to_osgb36_batch(["SJ637560", gridref])
@@ -0,0 +1,281 @@
+import asyncio
+import gc
+import io
+import os
+import shutil
+import weakref
+from types import SimpleNamespace
+
+from fastapi.testclient import TestClient
+import mercantile
+import numpy as np
+import pytest
+import rasterio as rio
+from rasterio.enums import Resampling
+from rasterio.transform import from_bounds
+from rasterio.warp import reproject
+from PIL import Image
+
+from imagery_api import main
+from imagery_api.utils.cogs import to_web_cog
+
+
+def reference_tile(raw_path, tile):
+    """
+    Reproject the source imagery straight onto the tile's grid
+    """
+    expected = np.zeros((3, main.IMAGE_SIZE, main.IMAGE_SIZE), dtype=np.uint8)
+    with rio.open(raw_path) as raw:
+        reproject(
+            rio.band(raw, [1, 2, 3]),
+            expected,
+            dst_transform=from_bounds(
+                *mercantile.xy_bounds(tile), main.IMAGE_SIZE, main.IMAGE_SIZE
+            ),
+            dst_crs=raw.crs,
+            resampling=Resampling.nearest,
+        )
+    return expected
+
+
+@pytest.fixture
+def src(cog_path):
+    with rio.open(cog_path) as src:
+        yield src
+
+
+@pytest.fixture
+def block_reads(monkeypatch):
+    """
+    Record the width of each dataset read through read_block_aligned
+    """
+    widths = []
+    read_block_aligned = main.read_block_aligned
+
+    def spy(dataset, window):
+        widths.append(dataset.width)
+        return read_block_aligned(dataset, window)
+
+    monkeypatch.setattr(main, "read_block_aligned", spy)
+    return widths
+
+
+@pytest.mark.parametrize("use_window_cache", [True, False])
+@pytest.mark.parametrize(
+    "tile, overview",
+    [
+        # Native resolution, read as whole blocks of the full image
+        (mercantile.Tile(x=32401, y=21601, z=16), None),
+        # Exact match for the 2x and 4x overviews
+        (mercantile.Tile(x=16200, y=10800, z=15), 0),
+        (mercantile.Tile(x=8100, y=5400, z=14), 1),
+    ],
+)
+def test_read_tile_unresampled(
+    src, raw_path, block_reads, tile, overview, use_window_cache
+):
+    window_cache = main.tile_windows(src, main.IMAGE_SIZE) if use_window_cache else {}
+    assert (tile in window_cache) == use_window_cache
+
+    data = main.read_tile(src, tile, main.IMAGE_SIZE, window_cache)
+
+    factor = 1 if overview is None else src.overviews(1)[overview]
+    assert block_reads == [-(-src.width // factor)]
+    np.testing.assert_array_equal(data, reference_tile(raw_path, tile))
+
+
+def test_read_tile_boundless(src, raw_path, block_reads):
+    # An 8x decimated tile, with no matching overview, that only half covers the imagery
+    tile = mercantile.Tile(x=4050, y=2700, z=13)
+    window = mercantile.xy_bounds(tile)
+    assert not main.window_inside(rio.windows.from_bounds(*window, src.transform), src)
+
+    data = main.read_tile(src, tile, main.IMAGE_SIZE, {})
+
+    assert block_reads == []
+    expected = reference_tile(raw_path, tile)
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(data, expected)
+
+
+def test_read_tile_outside_bounds(src):
+    with pytest.raises(main.TileOutsideBounds):
+        main.read_tile(src, mercantile.Tile(x=0, y=0, z=3), main.IMAGE_SIZE, {})
+
+
+def test_thread_dataset_released_with_src(cog_path, tmp_path):
+    copy = shutil.copy(cog_path, tmp_path / "copy.tif")
+    old_src = rio.open(cog_path)
+    old_handles = [main.thread_dataset(old_src), main.thread_dataset(old_src, 0)]
+    assert main.thread_dataset(old_src) is old_handles[0]
+
+    # Reading from a replacement closes this thread's handles on the old file
+    with rio.open(copy) as new_src:
+        new_handle = main.thread_dataset(new_src)
+        assert all(handle.closed for handle in old_handles)
+        assert not new_handle.closed
+
+        # and nothing left holds on to the old dataset
+        refs = [weakref.ref(dataset) for dataset in [old_src, *old_handles]]
+        del old_src, old_handles
+        gc.collect()
+        assert all(ref() is None for ref in refs)
+        assert new_handle in main._thread_datasets
+    new_handle.close()
+
+
+@pytest.mark.parametrize("dtype", [np.uint8, np.uint16, np.int16, np.float32])
+def test_to_rgba(dtype):
+    values = np.array(
+        [-40000, -256, -1, -0.5, 0, 0.5, 1, 254.5, 255, 256, 40000, 65535]
+    )
+    if np.issubdtype(dtype, np.integer):
+        info = np.iinfo(dtype)
+        values = values[(values >= info.min) & (values <= info.max)]
+        values = np.unique(values.astype(dtype))
+    rng = np.random.default_rng(0)
+    data = rng.choice(values, (3, 16, 16)).astype(dtype)
+    # Pixels that are all zero, and ones that are only zero once clipped
+    data[:, 0, :4] = 0
+    data[:, 1, :4] = values.min()
+
+    rgba = main.to_rgba(data)
+
+    rgb = np.clip(data, 0, 255).astype(np.uint8)
+    alpha = (rgb != 0).any(axis=0).astype(np.uint8) * 255
+    assert rgba.dtype == np.uint8 and rgba.shape == (16, 16, 4)
+    np.testing.assert_array_equal(rgba, np.dstack([*rgb, alpha]))
+    assert not rgba[0, :4].any()
+
+
+@pytest.fixture
+def tile_dir(tmp_path, monkeypatch):
+    tile_dir = tmp_path / "cogs"
+    tile_dir.mkdir()
+    monkeypatch.setattr(main, "TILE_DIR", tile_dir)
+    return tile_dir
+
+
+@pytest.fixture
+def client(tile_dir, cog_path):
+    shutil.copy(cog_path, tile_dir / "fixture.tif")
+    with TestClient(main.app) as client:
+        yield client
+
+
+TILE_URL = "/tile/16/32401/21601"
+
+
+def test_get_tile_etag(client):
+    response = client.get(TILE_URL)
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert response.headers["cache-control"] == main.CACHE_CONTROL
+    assert response.headers["etag"].startswith('"')
+    assert Image.open(io.BytesIO(response.content)).size == (256, 256)
+
+
+@pytest.mark.parametrize(
+    "if_none_match",
+    ["{etag}", '"stale", {etag}', "*"],
+)
+def test_get_tile_not_modified(client, if_none_match):
+    etag = client.get(TILE_URL).headers["etag"]
+
+    response = client.get(
+        TILE_URL, headers={"If-None-Match": if_none_match.format(etag=etag)}
+    )
+
+    assert response.status_code == 304
+    assert response.content == b""
+    assert response.headers["etag"] == etag
+
+
+def test_get_tile_modified(client):
+    etag = client.get(TILE_URL).headers["etag"]
+
+    response = client.get(TILE_URL, headers={"If-None-Match": '"stale"'})
+
+    assert response.status_code == 200
+    assert response.headers["etag"] == etag
+    assert response.content
+
+
+def test_get_tile_webp(client):
+    response = client.get(TILE_URL, params={"fmt": "webp"})
+
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    assert Image.open(io.BytesIO(response.content)).format == "WEBP"
+    assert response.headers["etag"] != client.get(TILE_URL).headers["etag"]
+
+
+def test_get_tile_rewritten_cog(client, tile_dir, raw_path, tmp_path):
+    etag = client.get(TILE_URL).headers["etag"]
+
+    # Rewrite the served COG from inverted imagery
+    inverted_path = tmp_path / "inverted.tif"
+    with rio.open(raw_path) as raw:
+        profile = raw.profile
+        data = raw.read()
+    with rio.open(inverted_path, "w", **profile) as dst:
+        dst.write(255 - data)
+    cog = tile_dir / "fixture.tif"
+    mtime = cog.stat().st_mtime
+    os.replace(to_web_cog(inverted_path, tmp_path / "new.tif"), cog)
+    os.utime(cog, (mtime + 10, mtime + 10))
+
+    assert client.get(TILE_URL).headers["etag"] != etag
+
+
+def test_get_tile_cog_added_after_startup(tile_dir, cog_path):
+    with TestClient(main.app) as client:
+        assert client.get(TILE_URL).content == main._BLANK_TILES["png"]
+
+        shutil.copy(cog_path, tile_dir / "fixture.tif")
+
+        assert client.get("/list_tiles/").json()["count"] == 1
+        assert client.get(TILE_URL).content != main._BLANK_TILES["png"]
+
+
+def test_concurrent_refresh_opens_once(tile_dir, cog_path, monkeypatch):
+    shutil.copy(cog_path, tile_dir / "fixture.tif")
+    opened = []
+    open_source = main.open_source
+
+    def spy(state, path, mtime):
+        opened.append(path)
+        open_source(state, path, mtime)
+
+    monkeypatch.setattr(main, "open_source", spy)
+    state = SimpleNamespace(tiles=[], tiles_mtime=None, failed_source=None)
+    state.source = main.Source()
+
+    async def refresh_concurrently():
+        state.refresh_lock = asyncio.Lock()
+        await asyncio.gather(*(main.refresh_source(state) for _ in range(8)))
+
+    asyncio.run(refresh_concurrently())
+
+    assert opened == [tile_dir / "fixture.tif"]
+    assert state.source.path == tile_dir / "fixture.tif"
+    state.source.src.close()
+
+
+def test_unreadable_cog(tile_dir, cog_path):
+    partial = tile_dir / "fixture.tif"
+    partial.write_bytes(cog_path.read_bytes()[:16])
+
+    with TestClient(main.app) as client:
+        assert client.get("/list_tiles/").json()["count"] == 1
+        assert client.get(TILE_URL).content == main._BLANK_TILES["png"]
+        assert main.app.state.source.path is None
+
+        # Once the copy completes the file is picked up
+        shutil.copy(cog_path, partial)
+        mtime = partial.stat().st_mtime
+        os.utime(partial, (mtime + 10, mtime + 10))
+
+        assert client.get(TILE_URL).content != main._BLANK_TILES["png"]
+        assert main.app.state.source.path == partial
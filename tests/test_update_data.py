@@ -0,0 +1,93 @@
+import sys
+from pathlib import Path
+
+import geopandas as gpd
+import pandas as pd
+import pytest
+import shapely
+
+# The update script imports its sibling geo module as a top level module, as it does
+# when run from its own directory
+sys.path.insert(
+    0, str(Path(__file__).parents[1] / "imagery_api" / "utils" / "update_data")
+)
+
+from imagery_api.utils.update_data.main import (  # noqa: E402
+    parse_geometry,
+    parse_response,
+    tile_gdf,
+)
+
+
+def box_bounds(gdf):
+    return sorted(tuple(bounds) for bounds in gdf.geometry.bounds.to_numpy())
+
+
+def test_tile_gdf():
+    gdf = gpd.GeoDataFrame(
+        geometry=[
+            shapely.MultiPolygon(
+                [shapely.box(10, 10, 40, 40), shapely.box(110, 310, 140, 340)]
+            ),
+            # A self intersecting bow-tie, which make_valid splits into two triangles
+            # meeting at (300, 100)
+            shapely.Polygon([(210, 10), (390, 190), (390, 10), (210, 190)]),
+        ],
+        crs="EPSG:27700",
+    )
+    assert not gdf.is_valid.iloc[1]
+
+    tiles = tile_gdf(gdf, 100)
+
+    assert tiles.crs == gdf.crs
+    assert box_bounds(tiles) == [
+        (0, 0, 100, 100),
+        (100, 300, 200, 400),
+        (200, 0, 300, 100),
+        (200, 100, 300, 200),
+        (300, 0, 400, 100),
+        (300, 100, 400, 200),
+    ]
+    assert len(tile_gdf(gdf, 100, filter_empty=False)) == 16
+
+
+@pytest.mark.parametrize(
+    "tile_id, expected",
+    [
+        ("SJ6356", (363000, 356000, 368000, 361000)),
+        ("SJ637560", (363700, 356000, 364200, 356500)),
+        ("SJ63755605", (363750, 356050, 363800, 356100)),
+        ("SJ6375156052", (363751, 356052, 363756, 356057)),
+    ],
+)
+def test_parse_geometry(tile_id, expected):
+    gdf = parse_geometry(pd.DataFrame({"tile_id": [tile_id], "id": [1]}))
+
+    assert gdf.crs == "EPSG:27700"
+    assert gdf.id.tolist() == [1]
+    assert tuple(gdf.geometry.bounds.iloc[0]) == expected
+
+
+def test_parse_response():
+    json_columns = ["product", "year", "resolution", "tile", "label"]
+    records = [
+        {
+            "uri": f"tile-{i}",
+            **{
+                col: {"id": f"{col}-{i}", "label": f"{col.title()} {i}"}
+                for col in json_columns
+            },
+        }
+        for i in range(3)
+    ]
+    results_df = pd.DataFrame.from_records(records, index=[10, 11, 12])
+
+    parsed = parse_response(results_df)
+
+    assert parsed.columns.tolist() == ["uri"] + [
+        f"{col}_{key}" for col in json_columns for key in ["id", "label"]
+    ]
+    assert parsed.index.tolist() == [10, 11, 12]
+    assert parsed.uri.tolist() == ["tile-0", "tile-1", "tile-2"]
+    assert parsed.year_id.tolist() == ["year-0", "year-1", "year-2"]
+    assert parsed.tile_label.tolist() == ["Tile 0", "Tile 1", "Tile 2"]